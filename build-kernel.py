@@ -5,6 +5,9 @@ import subprocess
 import shutil
 import argparse
 import re
+import fnmatch
+import zipfile
+import mmap
 from datetime import datetime
 import utils
 
@@ -29,19 +32,25 @@ KERNEL_OUT = "out/arch/arm64/boot"
 ANYKERNEL_DIR = "AnyKernel3"
 LOG_FILE = "build.log"
 
+# AnyKernel3 files left out of the flashable zip
+ZIP_EXCLUDES = (".git*", "README.md", "*placeholder", ".gitignore")
+# Already compressed payloads, deflating them again gains nothing
+STORED_SUFFIXES = (".gz", ".lz4", ".xz", ".zip")
+
+# Version banner in the kernel Image, printable bytes only like strings(1)
+LINUX_VERSION_RE = re.compile(rb"Linux version (\d[\x21-\x7e]*)")
+
 BUILD_PROCESS = None
 
 
 def get_git_head():
     try:
-        short_hash = subprocess.check_output(
-            ["git", "rev-parse", "--short", "HEAD"], text=True
-        ).strip()
-        full_hash = subprocess.check_output(
-            ["git", "rev-parse", "HEAD"], text=True
-        ).strip()
+        # One rev-parse prints both the full and the short hash
+        full_hash, short_hash = subprocess.check_output(
+            ["git", "rev-parse", "HEAD", "--short", "HEAD"], text=True
+        ).split()
         origin = subprocess.check_output(
-            ["git", "remote", "get-url", "origin"], text=True
+            ["git", "config", "--get", "remote.origin.url"], text=True
         ).strip()
 
         if origin.endswith(".git"):
@@ -81,20 +90,25 @@ def get_compiler_version():
 
 def get_compiled_version_string():
     image_path = os.path.join(KERNEL_OUT, "Image")
-    if not os.path.exists(image_path):
-        return None
     try:
-        cmd = f"strings {image_path} | grep 'Linux version [0-9]' | head -n 1"
-        line_out = subprocess.check_output(cmd, shell=True, text=True).strip()
-        match = re.search(r"Linux version (\S+)", line_out)
-        if match:
-            return match.group(1)
+        with open(image_path, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                match = LINUX_VERSION_RE.search(mm)
+                # The match borrows the map, read it before the map closes
+                return match.group(1).decode() if match else None
+    except FileNotFoundError:
+        return None
     except Exception as e:
         print(f"Version Extraction Error: {e}")
         pass
     return None
 
 
+# Matches zip -x, patterns are checked against the path inside the zip
+def is_excluded(rel):
+    return any(fnmatch.fnmatch(rel, pattern) for pattern in ZIP_EXCLUDES)
+
+
 # Package the kernel using AnyKernel3
 def package_anykernel(version_string):
     print("Packaging AnyKernel3...")
@@ -138,7 +152,7 @@ def package_anykernel(version_string):
         src = os.path.join(KERNEL_OUT, src_name)
         dst = os.path.join(ANYKERNEL_DIR, dst_name)
         if os.path.exists(src):
-            shutil.copy(src, dst)
+            shutil.copyfile(src, dst)
             print(f"Copied: {src_name} -> {dst_name}")
         else:
             print(f"Warning: Source file not found: {src}")
@@ -147,24 +161,35 @@ def package_anykernel(version_string):
     ver_tag = version_string if version_string else "Unknown-Kernel"
     zip_name = f"{ver_tag}-{timestamp}.zip"
 
-    cwd = os.getcwd()
-    os.chdir(ANYKERNEL_DIR)
-
-    # Create the zip package
-    zip_cmd = [
-        "zip",
-        "-r9",
-        "-q",
-        f"../{zip_name}",
-        ".",
-        "-x",
-        ".git*",
-        "README.md",
-        "*placeholder",
-        ".gitignore",
-    ]
-    subprocess.call(zip_cmd)
-    os.chdir(cwd)
+    # Create the zip package, compressed payloads are stored as-is
+    try:
+        with zipfile.ZipFile(
+            zip_name, "w", zipfile.ZIP_DEFLATED, compresslevel=1
+        ) as zf:
+            for root, dirs, files in os.walk(ANYKERNEL_DIR):
+                rel_root = os.path.relpath(root, ANYKERNEL_DIR)
+                if rel_root != ".":
+                    # Keep directory entries like zip -r does
+                    zf.write(root, rel_root)
+                    prefix = rel_root + "/"
+                else:
+                    prefix = ""
+                # Directories excluded as a whole, like .git, aren't walked
+                dirs[:] = sorted(d for d in dirs if not is_excluded(prefix + d + "/"))
+                for file_name in sorted(files):
+                    path = os.path.join(root, file_name)
+                    rel = prefix + file_name
+                    if is_excluded(rel):
+                        continue
+                    compress = (
+                        zipfile.ZIP_STORED
+                        if file_name.endswith(STORED_SUFFIXES)
+                        else zipfile.ZIP_DEFLATED
+                    )
+                    zf.write(path, rel, compress_type=compress)
+    except OSError as e:
+        print(f"Zip Error: {e}")
+        return None
 
     if os.path.exists(zip_name):
         return os.path.abspath(zip_name)
@@ -179,20 +204,22 @@ def main():
     parser.add_argument("-c", "--clean", action="store_true")
     args = parser.parse_args()
 
-    # Clean output if requested
+    # Clean output if requested, rm is much faster than rmtree on big trees
     if args.clean and os.path.exists("out"):
         print("Cleaning out/...")
-        shutil.rmtree("out")
+        subprocess.check_call(["rm", "-rf", "out"])
 
     git_head_link = get_git_head()
     compiler_ver = get_compiler_version()
 
-    base_info = (
-        f"<b>Head:</b> <code>{git_head_link}</code>\n"
+    # Rendered once, only the local version line is added after defconfig
+    base_head = f"<b>Head:</b> <code>{git_head_link}</code>\n"
+    base_tail = (
         f"{utils.line('Defconfig', DEFCONFIG)}\n"
-        f"{utils.line('Jobs', DISPLAY_JOBS)}\n"
-        f"{utils.line('Compiler', compiler_ver)}"
+        f"{utils.safe_line('Jobs', DISPLAY_JOBS)}\n"
+        f"{utils.safe_line('Compiler', compiler_ver)}"
     )
+    base_info = base_head + base_tail
 
     msg_id = utils.send_msg(utils.MESSAGES["build_start"].format(base_info=base_info))
 
@@ -204,13 +231,10 @@ def main():
     local_ver = get_localversion()
 
     # Update info with local version
-    base_info = (
-        f"<b>Head:</b> <code>{git_head_link}</code>\n"
-        f"{utils.line('Local Version', local_ver)}\n"
-        f"{utils.line('Defconfig', DEFCONFIG)}\n"
-        f"{utils.line('Jobs', DISPLAY_JOBS)}\n"
-        f"{utils.line('Compiler', compiler_ver)}"
-    )
+    base_info = f"{base_head}{utils.line('Local Version', local_ver)}\n{base_tail}"
+
+    # Static parts of the progress message, only the stats change per edit
+    progress_head, progress_tail = utils.progress_parts(base_info)
 
     # Build command
     build_cmd = [
@@ -226,52 +250,44 @@ def main():
     print(f"Building: {' '.join(build_cmd)}")
 
     start_time = time.time()
-    log_file = open(LOG_FILE, "w")
+    log_file = utils.BuildLog(LOG_FILE)
 
     # Start build process
     BUILD_PROCESS = subprocess.Popen(
         build_cmd,
         stdout=subprocess.PIPE,
         stderr=subprocess.STDOUT,
-        text=True,
-        bufsize=1,
+        bufsize=0,
+        start_new_session=True,
     )
 
     last_update = 0
 
-    # Monitor build output
+    # Monitor build output, Telegram edits go through a background thread
+    progress = utils.ProgressUpdater(msg_id)
     try:
-        while True:
-            line_out = BUILD_PROCESS.stdout.readline()
-            if not line_out and BUILD_PROCESS.poll() is not None:
-                break
-            if not line_out:
-                time.sleep(0.1)
-                continue
-
-            log_file.write(line_out)
+        # Wakes on output or after 15s of silence to keep the timer ticking
+        for chunk in utils.iter_output(BUILD_PROCESS.stdout, timeout=15):
+            if chunk:
+                log_file.write(chunk)
+            else:
+                log_file.flush()
 
-            now = time.time()
+            now = time.monotonic()
             if now - last_update > 15:
-                elapsed = utils.fmt_time(now - start_time)
-                stats_str = f"<b>Elapsed:</b> <code>{elapsed}</code>"
-                utils.edit_msg(
-                    msg_id,
-                    utils.MESSAGES["build_progress"].format(
-                        stats=stats_str, base_info=base_info
-                    ),
-                )
+                elapsed = utils.fmt_time(time.time() - start_time)
+                stats_str = utils.safe_line("Elapsed", elapsed)
+                progress.update(progress_head + stats_str + progress_tail)
                 last_update = now
 
-        return_code = BUILD_PROCESS.poll()
-        if return_code is None:
-            return_code = BUILD_PROCESS.wait()
+        return_code = BUILD_PROCESS.wait()
 
     except Exception as e:
         print(f"Build Loop Error: {e}")
         return_code = 1
     finally:
         log_file.close()
+        progress.stop()
 
     total_duration = utils.fmt_time(time.time() - start_time)
 
@@ -310,16 +326,19 @@ def main():
     # Upload files
     upload_start = time.time()
     files_to_upload = [("Download", final_zip)]
+    for label, file_path in files_to_upload:
+        print(f"Uploading {label} ({os.path.basename(file_path)})...")
+
+    # Start every upload together so mirrors and files overlap
+    all_uploads = utils.upload_many(
+        [file_path for _, file_path in files_to_upload], USE_GOFILE
+    )
 
     buttons_list = []
     main_file_uploaded = False
 
     for label, file_path in files_to_upload:
-        if not file_path or not os.path.exists(file_path):
-            continue
-
-        print(f"Uploading {label} ({os.path.basename(file_path)})...")
-        uploads = utils.upload_all(file_path, USE_GOFILE)
+        uploads = all_uploads[file_path]
 
         if uploads["pd"]:
             buttons_list.append({"text": f"{label} (PD)", "url": uploads["pd"]})
@@ -333,8 +352,11 @@ def main():
 
     upload_duration = utils.fmt_time(time.time() - upload_start)
 
-    md5 = utils.get_md5(final_zip)
-    size_mb = os.path.getsize(final_zip) / (1024 * 1024)
+    md5 = all_uploads[final_zip]["md5"] or utils.get_md5(final_zip)
+    size = all_uploads[final_zip]["size"]
+    if size is None:
+        size = os.path.getsize(final_zip)
+    size_mb = size / (1024 * 1024)
     size_str = f"{size_mb:.2f} MB"
     file_name = os.path.basename(final_zip)
 
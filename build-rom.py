@@ -3,8 +3,10 @@ import sys
 import time
 import subprocess
 import re
-import glob
+import json
+import hashlib
 import argparse
+import concurrent.futures
 import utils
 
 # Load config variables
@@ -16,14 +18,16 @@ TARGET = os.environ.get("CONFIG_BUILD_TARGET")
 BUILD_VARIANT = os.environ.get("CONFIG_BUILD_TYPE")
 USE_GOFILE = os.environ.get("CONFIG_GOFILE") == "true"
 REC_IMAGES = os.environ.get("CONFIG_RECOVERY_IMAGES")
+VERBOSE = os.environ.get("CONFIG_VERBOSE") == "true"
 
 if not all([BOT_TOKEN, CHAT_ID, DEVICE, TARGET, BUILD_VARIANT]):
     print("ERROR: Missing configuration (BOT_TOKEN, CHATID, DEVICE, TARGET, or TYPE).")
     sys.exit(1)
 
 cpu_cores = os.cpu_count()
+build_jobs = utils.get_build_jobs(cpu_cores) if cpu_cores else None
 jobs_env = os.environ.get("CONFIG_JOBS")
-JOBS_FLAG = f"-j{jobs_env}" if jobs_env else (f"-j{cpu_cores}" if cpu_cores else "")
+JOBS_FLAG = f"-j{jobs_env}" if jobs_env else (f"-j{build_jobs}" if build_jobs else "")
 SYNC_JOBS = jobs_env if jobs_env else (str(cpu_cores) if cpu_cores else "4")
 
 current_folder = os.getcwd().split("/")[-1]
@@ -31,29 +35,114 @@ ROM_NAME = os.environ.get("CONFIG_ROM_NAME") or current_folder or "Unknown ROM"
 
 BUILD_PROCESS = None
 
+# Ninja progress line, used with match() so other lines fail on the first byte
+# Output is read as bytes, only the matched groups get decoded
+PROGRESS_RE = re.compile(rb"\[\s*(\d+)%\s+(\d+/\d+)(?:\s+([^\]]*?)\s*remaining)?")
 
-def get_build_vars():
-    print("Fetching build system variables...")
+# Marker echoed by the build shell once breakfast has set up the product
+VARS_MARKER = b"__VARS__ "
+
+# Build vars from the last run, so the first message isn't all N/A
+VARS_CACHE = "out/.build_vars.cache"
+VARS_CACHE_SOURCES = ("build/envsetup.sh", "build/make/core/build_id.mk")
+
+
+def get_vars_cache_key():
+    h = hashlib.blake2b(digest_size=16)
+    h.update(f"{DEVICE}\0{BUILD_VARIANT}".encode())
+    for src in VARS_CACHE_SOURCES:
+        try:
+            with open(src, "rb") as f:
+                h.update(f.read())
+        except OSError:
+            h.update(b"\0")
+    return h.hexdigest()
+
+
+def load_cached_build_vars():
     try:
-        cmd = (
-            f"source build/envsetup.sh && "
-            f"breakfast {DEVICE} {BUILD_VARIANT} >/dev/null 2>&1 && "
-            f'echo "VER=$(get_build_var PLATFORM_VERSION)" && '
-            f'echo "BID=$(get_build_var BUILD_ID)" && '
-            f'echo "TYPE=$(get_build_var TARGET_BUILD_VARIANT)"'
-        )
-        output = subprocess.check_output(
-            cmd, shell=True, executable="/bin/bash", text=True
-        )
-        d = {}
-        for out_line in output.splitlines():
-            if "=" in out_line:
-                k, v = out_line.split("=", 1)
-                d[k] = v.strip()
-        return d
-    except Exception as e:
-        print(f"Warning: Could not fetch vars: {e}")
-        return {"VER": "N/A", "BID": "N/A", "TYPE": BUILD_VARIANT}
+        with open(VARS_CACHE, "r") as f:
+            cache = json.load(f)
+        if cache.get("key") == get_vars_cache_key():
+            return cache.get("vars", {})
+    except (OSError, ValueError):
+        pass
+    return {}
+
+
+def save_cached_build_vars(build_vars):
+    try:
+        with open(VARS_CACHE, "w") as f:
+            json.dump({"key": get_vars_cache_key(), "vars": build_vars}, f)
+    except OSError as e:
+        print(f"Warning: Could not cache build vars: {e}")
+
+
+# Runs repo sync, echoing its stderr live while keeping a copy to parse
+def run_repo_sync(cmd):
+    process = subprocess.Popen(cmd, stderr=subprocess.PIPE)
+    fd = process.stderr.fileno()
+    captured = bytearray()
+    for chunk in iter(lambda: os.read(fd, 1 << 16), b""):
+        sys.stderr.buffer.write(chunk)
+        sys.stderr.buffer.flush()
+        captured += chunk
+    return process.wait(), captured.decode(errors="replace")
+
+
+# Projects reported as failed by repo sync, empty if none could be parsed
+def parse_failed_projects(sync_errors):
+    failed = []
+    in_list = False
+    for err_line in re.split(r"[\r\n]+", sync_errors):
+        err_line = err_line.strip()
+        if err_line.startswith("Failing repos"):
+            in_list = True
+            continue
+        if in_list:
+            if not err_line or " " in err_line:
+                in_list = False
+            else:
+                failed.append(err_line)
+                continue
+        match = re.match(r"error: Cannot (?:fetch|checkout) (\S+)", err_line)
+        if match:
+            failed.append(match.group(1))
+    return list(dict.fromkeys(failed))
+
+
+# Newest device artifact in out_dir with the given suffix, as a DirEntry
+# DirEntry caches its stat, so picking and sizing share one syscall
+def find_latest_artifact(out_dir, suffix):
+    try:
+        with os.scandir(out_dir) as it:
+            found = [
+                e
+                for e in it
+                if DEVICE in e.name and e.name.endswith(suffix) and e.is_file()
+            ]
+    except OSError:
+        return None
+    return max(found, key=lambda e: e.stat().st_ctime) if found else None
+
+
+def parse_build_vars(vars_line):
+    d = {}
+    for pair in vars_line.decode(errors="replace").split():
+        if "=" in pair:
+            k, v = pair.split("=", 1)
+            d[k] = v.strip()
+    return d
+
+
+def format_base_info(build_vars):
+    return (
+        f"{utils.line('Rom', ROM_NAME)}\n"
+        f"{utils.safe_line('Device', DEVICE)}\n"
+        f"{utils.safe_line('Android', build_vars.get('VER') or 'N/A')}\n"
+        f"{utils.safe_line('Build ID', build_vars.get('BID') or 'N/A')}\n"
+        f"{utils.safe_line('Type', build_vars.get('TYPE') or BUILD_VARIANT)}"
+    )
 
 
 def main():
@@ -69,12 +158,16 @@ def main():
     # Sync sources if requested
     if args.sync:
         start = time.time()
-        details = f"{utils.line('Rom', ROM_NAME)}\n{utils.line('Jobs', SYNC_JOBS)}"
+        details = f"{utils.line('Rom', ROM_NAME)}\n{utils.safe_line('Jobs', SYNC_JOBS)}"
         msg_id = utils.send_msg(utils.MESSAGES["sync_start"].format(details=details))
 
         cmd = f"repo sync -c -j{SYNC_JOBS} --optimized-fetch --prune --force-sync --no-clone-bundle --no-tags"
-        if subprocess.call(cmd.split()) != 0:
-            subprocess.call(f"repo sync -j{SYNC_JOBS}".split())
+        return_code, sync_errors = run_repo_sync(cmd.split())
+        if return_code != 0:
+            # Retry only what failed, a full resync redoes every project
+            failed = parse_failed_projects(sync_errors)
+            print(f"Retrying failed projects: {' '.join(failed) or 'all'}")
+            subprocess.call(f"repo sync -j{SYNC_JOBS}".split() + failed)
 
         dur = utils.fmt_time(time.time() - start)
         utils.edit_msg(
@@ -84,84 +177,112 @@ def main():
             ),
         )
 
-    # Clean output
+    # Clean output, rm walks millions of inodes far faster than rmtree
     if args.clean and os.path.exists("out"):
-        import shutil
-
-        shutil.rmtree("out")
-
-    # Build Setup
-    build_vars = get_build_vars()
-    ANDROID_VERSION = build_vars.get("VER", "N/A")
-    BUILD_ID = build_vars.get("BID", "N/A")
-    REAL_VARIANT = build_vars.get("TYPE", BUILD_VARIANT)
-
-    base_info = (
-        f"<b>Rom:</b> <code>{ROM_NAME}</code>\n"
-        f"<b>Device:</b> <code>{DEVICE}</code>\n"
-        f"<b>Android:</b> <code>{ANDROID_VERSION}</code>\n"
-        f"<b>Build ID:</b> <code>{BUILD_ID}</code>\n"
-        f"<b>Type:</b> <code>{REAL_VARIANT}</code>"
-    )
+        subprocess.check_call(["rm", "-rf", "out"])
+
+    # Build Setup, the real build vars arrive from the build shell itself
+    base_info = format_base_info(load_cached_build_vars())
 
     msg_id = utils.send_msg(utils.MESSAGES["build_start"].format(base_info=base_info))
 
-    build_cmd = f"source build/envsetup.sh && breakfast {DEVICE} {BUILD_VARIANT} && m {TARGET} {JOBS_FLAG}"
+    # Static parts of the progress message, only the stats change per edit
+    progress_head, progress_tail = utils.progress_parts(base_info)
+
+    # One envsetup + breakfast serves both the build vars and the build
+    echo_vars = (
+        f'echo "{VARS_MARKER.decode()}'
+        f"VER=$(get_build_var PLATFORM_VERSION) "
+        f"BID=$(get_build_var BUILD_ID) "
+        f'TYPE=$(get_build_var TARGET_BUILD_VARIANT)"'
+    )
+    build_cmd = (
+        f"source build/envsetup.sh && breakfast {DEVICE} {BUILD_VARIANT} && "
+        f"{echo_vars} && m {TARGET} {JOBS_FLAG}"
+    )
     print(f"Cmd: {build_cmd}")
 
-    log_file = open("build.log", "w")
+    # tee writes build.log natively, pipefail keeps the build's exit code
+    tee_cmd = f"set -o pipefail; {{ {build_cmd}; }} 2>&1 | tee build.log"
     start_time = time.time()
 
-    # Start build process
+    # Start build process, with VERBOSE its output is echoed to stdout's buffer
+    sys.stdout.flush()
     BUILD_PROCESS = subprocess.Popen(
-        build_cmd,
+        tee_cmd,
         shell=True,
         executable="/bin/bash",
         stdout=subprocess.PIPE,
         stderr=subprocess.STDOUT,
-        text=True,
-        bufsize=1,
+        bufsize=0,
+        start_new_session=True,
     )
 
-    regex = re.compile(r"\[\s*(\d+%)\s+(\d+/\d+)(?: (.*?remaining))?.*\]")
     last_update = 0
     ninja_started = False
+    vars_seen = False
     detected_zip = None
 
-    # Monitor build output
+    # Monitor build output, Telegram edits go through a background thread
+    progress = utils.ProgressUpdater(msg_id)
     try:
-        for log_line in BUILD_PROCESS.stdout:
-            sys.stdout.write(log_line)
-            log_file.write(log_line)
+        for batch_bytes in utils.iter_output(BUILD_PROCESS.stdout):
+            if VERBOSE:
+                sys.stdout.buffer.write(batch_bytes)
+                sys.stdout.buffer.flush()
+
+            if not vars_seen and VARS_MARKER in batch_bytes:
+                vars_line = batch_bytes.split(VARS_MARKER, 1)[1].split(b"\n", 1)[0]
+                build_vars = parse_build_vars(vars_line)
+                save_cached_build_vars(build_vars)
+                base_info = format_base_info(build_vars)
+                progress_head, progress_tail = utils.progress_parts(base_info)
+                progress.update(
+                    utils.MESSAGES["build_start"].format(base_info=base_info)
+                )
+                vars_seen = True
+
+            if b"Package Complete:" in batch_bytes:
+                pkg_line = batch_bytes.rsplit(b"Package Complete:", 1)[1]
+                detected_zip = pkg_line.strip().split()[0].decode(errors="replace")
+
+            if not ninja_started and b"Starting ninja..." in batch_bytes:
+                ninja_started = True
 
-            if "Package Complete:" in log_line:
-                detected_zip = log_line.split("Package Complete:")[1].strip().split()[0]
+            if not ninja_started:
+                continue
 
-            if "Starting ninja..." in log_line:
-                ninja_started = True
+            # Check the throttle first so most batches skip the scan entirely
+            now = time.monotonic()
+            if now - last_update <= 15:
+                continue
 
-            match = regex.search(log_line)
-            if match and ninja_started:
+            # Only the latest progress line matters for the status message
+            # Every progress line has a '%', a memchr is far cheaper than the regex
+            match = None
+            if b"%" in batch_bytes:
+                for log_line in reversed(batch_bytes.splitlines()):
+                    if b"%" not in log_line:
+                        continue
+                    match = PROGRESS_RE.match(log_line)
+                    if match:
+                        break
+
+            if match:
                 pct, cnt, time_left = match.groups()
-                now = time.time()
-
-                if now - last_update > 15:
-                    elapsed_str = utils.fmt_time(now - start_time)
-
-                    # Build Stats
-                    stats_str = f"<b>Progress:</b> <code>{pct} ({cnt})</code>\n"
-                    if time_left:
-                        clean_time = time_left.replace(" remaining", "").strip()
-                        stats_str += f"<b>Remaining:</b> <code>{clean_time}</code>\n"
-                    stats_str += f"<b>Elapsed:</b> <code>{elapsed_str}</code>"
-
-                    utils.edit_msg(
-                        msg_id,
-                        utils.MESSAGES["build_progress"].format(
-                            stats=stats_str, base_info=base_info
-                        ),
-                    )
-                    last_update = now
+                pct = int(pct)
+                cnt = cnt.decode()
+                elapsed_str = utils.fmt_time(time.time() - start_time)
+
+                # Build Stats
+                stats_str = utils.safe_line("Progress", f"{pct}% ({cnt})") + "\n"
+                if time_left:
+                    time_left = time_left.decode(errors="replace")
+                    stats_str += utils.safe_line("Remaining", time_left) + "\n"
+                stats_str += utils.safe_line("Elapsed", elapsed_str)
+
+                progress.update(progress_head + stats_str + progress_tail)
+                last_update = now
 
         return_code = BUILD_PROCESS.wait()
 
@@ -169,7 +290,7 @@ def main():
         print(f"Build Loop Error: {e}")
         return_code = 1
     finally:
-        log_file.close()
+        progress.stop()
 
     total_duration = utils.fmt_time(time.time() - start_time)
 
@@ -189,19 +310,19 @@ def main():
     final_build_msg = utils.MESSAGES["build_success"].format(
         time=total_duration, base_info=base_info
     )
-    utils.edit_msg(
-        msg_id, utils.MESSAGES["uploading"].format(build_msg=final_build_msg)
-    )
 
     # Locate/Prepare artifacts
     out_dir = f"out/target/product/{DEVICE}"
     final_zip = None
-    if detected_zip and os.path.exists(detected_zip):
+    final_stat = None
+    if detected_zip and os.path.isfile(detected_zip):
         final_zip = detected_zip
+        final_stat = os.stat(final_zip)
     else:
-        zips = glob.glob(f"{out_dir}/*{DEVICE}*.zip")
-        if zips:
-            final_zip = max(zips, key=os.path.getctime)
+        latest = find_latest_artifact(out_dir, ".zip")
+        if latest:
+            final_zip = latest.path
+            final_stat = latest.stat()
 
     if not final_zip:
         utils.edit_msg(
@@ -212,6 +333,16 @@ def main():
         )
         sys.exit(1)
 
+    # Start the main ZIP upload now, the rest of the prep overlaps with it
+    upload_start = time.time()
+    print(f"Uploading Download ({os.path.basename(final_zip)})...")
+    upload_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    main_upload = upload_pool.submit(utils.upload_many, [final_zip], USE_GOFILE)
+
+    utils.edit_msg(
+        msg_id, utils.MESSAGES["uploading"].format(build_msg=final_build_msg)
+    )
+
     # Packaging recovery images if requested
     rec_zip_path = None
     if REC_IMAGES:
@@ -231,26 +362,36 @@ def main():
             if os.path.exists(rec_name):
                 rec_zip_path = rec_name
 
-    # Upload files
-    upload_start = time.time()
-
-    files_to_upload = [("Download", final_zip)]
+    # Upload the remaining files alongside the main ZIP
+    extra_files = []
     if rec_zip_path:
-        files_to_upload.append(("Recovery", rec_zip_path))
+        extra_files.append(("Recovery", rec_zip_path))
+
+    latest_json = find_latest_artifact(out_dir, ".json")
+    if latest_json:
+        extra_files.append(("JSON", latest_json.path))
+
+    extra_files = [
+        (label, file_path)
+        for label, file_path in extra_files
+        if file_path and os.path.exists(file_path)
+    ]
+    for label, file_path in extra_files:
+        print(f"Uploading {label} ({os.path.basename(file_path)})...")
 
-    json_f = glob.glob(f"{out_dir}/*{DEVICE}*.json")
-    if json_f:
-        files_to_upload.append(("JSON", json_f[0]))
+    all_uploads = utils.upload_many(
+        [file_path for _, file_path in extra_files], USE_GOFILE
+    )
+    all_uploads.update(main_upload.result())
+    upload_pool.shutdown()
+
+    files_to_upload = [("Download", final_zip)] + extra_files
 
     buttons_list = []
     main_file_uploaded = False
 
     for label, file_path in files_to_upload:
-        if not file_path or not os.path.exists(file_path):
-            continue
-
-        print(f"Uploading {label} ({os.path.basename(file_path)})...")
-        uploads = utils.upload_all(file_path, USE_GOFILE)
+        uploads = all_uploads[file_path]
 
         current_row = []
 
@@ -269,8 +410,8 @@ def main():
 
     upload_duration = utils.fmt_time(time.time() - upload_start)
 
-    md5 = utils.get_md5(final_zip)
-    size_mb = os.path.getsize(final_zip) / (1024 * 1024)
+    md5 = all_uploads[final_zip]["md5"] or utils.get_md5(final_zip)
+    size_mb = final_stat.st_size / (1024 * 1024)
     size_str = f"{size_mb:.2f} MB"
     file_name = os.path.basename(final_zip)
 
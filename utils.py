@@ -1,21 +1,117 @@
 import os
+import stat
+import types
+import pathlib
+import functools
 import sys
 import time
 import json
-import html
 import base64
+import hashlib
+import random
+import selectors
 import requests
 import signal
 import subprocess
+import threading
+import queue
+import collections
 import concurrent.futures
-from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+from requests_toolbelt import MultipartEncoder
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# Parses a .env file into a read-only mapping, cached per file version
+@functools.lru_cache(maxsize=1)
+def _parse_config(path, mtime_ns):
+    config = {}
+    for entry in pathlib.Path(path).read_text().splitlines():
+        entry = entry.strip()
+        if not entry or entry.startswith("#"):
+            continue
+        key, sep, value = entry.partition("=")
+        if not sep:
+            continue
+        key = key.removeprefix("export ").strip()
+        value = value.strip()
+        quote = value[:1]
+        if quote in ("'", '"') and quote in value[1:]:
+            value = value[1 : value.index(quote, 1)]
+        else:
+            value = value.partition(" #")[0].strip()
+        config[key] = value
+    return types.MappingProxyType(config)
+
+
+# Load configs from .env file, existing environment variables take priority
+def load_config(path="config.env"):
+    try:
+        mtime_ns = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return
+    for key, value in _parse_config(path, mtime_ns).items():
+        os.environ.setdefault(key, value)
+
 
-# Load configs from .env file
-load_dotenv("config.env")
+load_config()
 BOT_TOKEN = os.environ.get("CONFIG_BOT_TOKEN")
 CHAT_ID = os.environ.get("CONFIG_CHATID")
 PD_API = os.environ.get("CONFIG_PDUP_API")
 
+
+# Whole number config value, unset or malformed values use the default
+def _env_int(key, default, minimum=1):
+    value = os.environ.get(key)
+    try:
+        number = int(value) if value else default
+    except ValueError:
+        print(f"Warning: {key}={value!r} is not a whole number, using {default}.")
+        number = default
+    return max(minimum, number)
+
+
+# Max PixelDrain uploads in flight, also the size of its connection pool
+PD_PARALLEL = _env_int("CONFIG_PD_PARALLEL", 4)
+
+# Bytes read from disk per upload body read, at least 1 MiB
+UPLOAD_CHUNK_SIZE = _env_int("CONFIG_PD_CHUNK_MB", 8) * 1024 * 1024
+
+# Build log output is gathered up to this size per write
+LOG_BATCH_BYTES = 64 * 1024
+
+# Max bytes taken from the build pipe per read
+OUTPUT_READ_SIZE = 64 * 1024
+
+# Memory budget per build job, used to cap the default job count
+MEM_PER_JOB_GB = 1.5
+
+# Telegram rate limits per chat
+TG_MIN_INTERVAL = 1.0
+TG_MAX_PER_MINUTE = 20
+TG_BACKOFF_CAP = 30
+# Min seconds between throttled edits of the same message
+EDIT_MIN_INTERVAL = 3.0
+
+
+# Keep-alive sessions so repeated requests reuse warm connections
+def _make_session(pool_maxsize):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_maxsize)
+    session.mount("https://", adapter)
+    return session
+
+
+_tg_session = _make_session(4)
+_TG_URL = f"https://api.telegram.org/bot{BOT_TOKEN}"
+_pd_session = _make_session(PD_PARALLEL)
+_pd_slots = threading.BoundedSemaphore(PD_PARALLEL)
+_gofile_session = _make_session(4)
+
 # Message templates for Telegram notifications
 MESSAGES = {
     "sync_start": "<b>ℹ️ | Starting Synchronization...</b>\n{details}",
@@ -41,47 +137,272 @@ MESSAGES = {
 }
 
 
+# Usable memory in bytes, honoring a container cgroup limit if set
+def get_memory_limit():
+    limit = None
+    try:
+        limit = os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError):
+        pass
+
+    for cgroup_file in (
+        "/sys/fs/cgroup/memory.max",
+        "/sys/fs/cgroup/memory/memory.limit_in_bytes",
+    ):
+        try:
+            with open(cgroup_file, "r") as f:
+                value = f.read().strip()
+        except OSError:
+            continue
+        if value.isdigit():
+            limit = min(limit, int(value)) if limit else int(value)
+        break
+    return limit
+
+
+# Caps the job count so link-heavy steps don't run out of memory
+def get_build_jobs(cpu_cores):
+    mem = get_memory_limit()
+    if not mem:
+        return cpu_cores
+    return min(cpu_cores, max(1, int(mem / (1 << 30) / MEM_PER_JOB_GB)))
+
+
 # Formatting
 def fmt_time(seconds):
-    seconds = int(seconds)
-    h = seconds // 3600
-    m = (seconds % 3600) // 60
-    s = seconds % 60
+    return _fmt_seconds(int(seconds))
+
+
+# Keyed on whole seconds so repeated ticks within a second hit the cache
+@functools.lru_cache(maxsize=4096)
+def _fmt_seconds(seconds):
+    m, s = divmod(seconds, 60)
+    h, m = divmod(m, 60)
     return f"{h:02d}:{m:02d}:{s:02d}"
 
 
+_HTML_ESCAPE = str.maketrans({"&": "&amp;", "<": "&lt;", ">": "&gt;"})
+
+
 def line(label, value):
-    return f"<b>{label}:</b> <code>{html.escape(str(value))}</code>"
+    value = value if type(value) is str else str(value)
+    if not value.isalnum():
+        value = value.translate(_HTML_ESCAPE)
+    return f"<b>{label}:</b> <code>{value}</code>"
+
+
+# For machine-formatted values that never contain HTML special characters
+def safe_line(label, value):
+    return f"<b>{label}:</b> <code>{value}</code>"
+
+
+# Static head and tail of the progress message, only the stats go between
+def progress_parts(base_info):
+    head, tail = MESSAGES["build_progress"].split("{stats}")
+    return head, tail.format(base_info=base_info)
+
+
+# Stat of a regular file, None if it is missing or something else
+def _stat(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st if stat.S_ISREG(st.st_mode) else None
 
 
 def get_md5(file_path):
-    if not os.path.exists(file_path):
-        return "N/A"
     try:
-        return subprocess.check_output(["md5sum", file_path], text=True).split()[0]
+        with open(file_path, "rb") as f:
+            if hasattr(hashlib, "file_digest"):
+                return hashlib.file_digest(f, "md5").hexdigest()
+            h = hashlib.md5()
+            for chunk in iter(lambda: f.read(4 << 20), b""):
+                h.update(chunk)
+            return h.hexdigest()
     except Exception:
         return "N/A"
 
 
+# MD5 plus byte count of the data fed through an UploadReader
+class FileDigest:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.md5 = hashlib.md5()
+        self.size = 0
+
+    def update(self, data):
+        self.md5.update(data)
+        self.size += len(data)
+
+    def hexdigest(self):
+        return self.md5.hexdigest()
+
+
+# Upload body that reads in large chunks and optionally hashes as it goes
+# HTTP clients ask for small blocks, reading more per call cuts syscalls
+# len() is the bytes left to read, MultipartEncoder streams until it hits 0
+class UploadReader:
+    def __init__(self, f, size, hasher=None, chunk_size=UPLOAD_CHUNK_SIZE):
+        self.f = f
+        self.remaining = size
+        self.hasher = hasher
+        self.chunk_size = chunk_size
+
+    def read(self, n=-1):
+        if 0 <= n < self.chunk_size:
+            n = self.chunk_size
+        chunk = self.f.read(n)
+        # A file cut short must still end the stream
+        self.remaining = max(0, self.remaining - len(chunk)) if chunk else 0
+        if self.hasher:
+            self.hasher.update(chunk)
+        return chunk
+
+    def __len__(self):
+        return self.remaining
+
+
+# Build log on a raw fd, writes are batched into single os.write calls
+class BuildLog:
+    def __init__(self, path):
+        self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        self.pending = []
+        self.pending_size = 0
+
+    def write(self, data):
+        # Full-size chunks go straight to the fd without a join copy
+        if not self.pending and len(data) >= LOG_BATCH_BYTES:
+            self._write_all(data)
+            return
+        self.pending.append(data)
+        self.pending_size += len(data)
+        if self.pending_size >= LOG_BATCH_BYTES:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        data = b"".join(self.pending)
+        self.pending = []
+        self.pending_size = 0
+        self._write_all(data)
+
+    def _write_all(self, data):
+        data = memoryview(data)
+        while data:
+            written = os.write(self.fd, data)
+            data = data[written:]
+
+    def close(self):
+        self.flush()
+        os.close(self.fd)
+
+
+# Reads a build pipe in large chunks, yielding blocks of whole lines
+# With a timeout, an empty block is yielded whenever the pipe stays quiet
+def iter_output(stream, timeout=None):
+    fd = stream.fileno()
+    partial = b""
+    with selectors.DefaultSelector() as sel:
+        sel.register(fd, selectors.EVENT_READ)
+        while True:
+            if not sel.select(timeout):
+                yield b""
+                continue
+            chunk = os.read(fd, OUTPUT_READ_SIZE)
+            if not chunk:
+                if partial:
+                    yield partial
+                return
+
+            data = partial + chunk
+            cut = data.rfind(b"\n") + 1
+            if cut:
+                yield data[:cut]
+            partial = data[cut:]
+
+
 # Telegram API
+_tg_lock = threading.Lock()
+_tg_sent = {}
+
+
+# Waits for a free slot in the chat's rate limit window
+def _tg_throttle(chat_id):
+    with _tg_lock:
+        now = time.monotonic()
+        sent = _tg_sent.setdefault(chat_id, collections.deque())
+        while sent and now - sent[0] >= 60:
+            sent.popleft()
+
+        wait = 0
+        if sent:
+            wait = max(wait, sent[-1] + TG_MIN_INTERVAL - now)
+        if len(sent) >= TG_MAX_PER_MINUTE:
+            wait = max(wait, sent[0] + 60 - now)
+        sent.append(now + wait)
+
+    if wait > 0:
+        time.sleep(wait)
+
+
+# Exponential backoff with jitter between Telegram retries
+def _tg_backoff(attempt):
+    return min(TG_BACKOFF_CAP, 2**attempt) + random.random()
+
+
+# Streams files from their handles, rewound so a retry resends them whole
+def _tg_multipart(data, files):
+    fields = {key: str(value) for key, value in data.items()}
+    for key, f in files.items():
+        f.seek(0)
+        fields[key] = (os.path.basename(f.name), f, "application/octet-stream")
+    return MultipartEncoder(fields=fields)
+
+
 def tg_req(method, data, files=None, retries=3):
     if not BOT_TOKEN:
         print("Error: BOT_TOKEN missing in utils.")
         return {}
 
-    url = f"https://api.telegram.org/bot{BOT_TOKEN}/{method}"
+    url = f"{_TG_URL}/{method}"
     for attempt in range(retries):
+        _tg_throttle(data.get("chat_id"))
         try:
-            r = requests.post(url, data=data, files=files, timeout=30)
+            if files:
+                body = _tg_multipart(data, files)
+                headers = {"Content-Type": body.content_type}
+                r = _tg_session.post(url, data=body, headers=headers, timeout=30)
+            else:
+                r = _tg_session.post(url, data=data, timeout=30)
             if r.status_code == 200:
                 return r.json()
+            if r.status_code == 429:
+                retry_after = r.json().get("parameters", {}).get("retry_after", 2)
+                print(f"[Telegram Rate Limit] Retrying in {retry_after}s")
+                time.sleep(retry_after)
+                continue
             print(f"[Telegram Error {r.status_code}] {r.text}")
+            # Other client errors won't change on retry
+            if r.status_code < 500:
+                return {}
         except Exception as e:
             print(f"[Telegram Retry {attempt+1}/{retries}] {e}")
-            time.sleep(2)
+        if attempt < retries - 1:
+            time.sleep(_tg_backoff(attempt))
     return {}
 
 
+# orjson is optional, json is used when it isn't installed
+def _dump_markup(buttons):
+    if orjson:
+        return orjson.dumps({"inline_keyboard": buttons}).decode()
+    return json.dumps({"inline_keyboard": buttons}, separators=(",", ":"))
+
+
 def _get_tg_payload(chat_id, text, buttons=None, msg_id=None):
     data = {
         "chat_id": chat_id,
@@ -92,7 +413,7 @@ def _get_tg_payload(chat_id, text, buttons=None, msg_id=None):
     if msg_id:
         data["message_id"] = msg_id
     if buttons:
-        data["reply_markup"] = json.dumps({"inline_keyboard": buttons})
+        data["reply_markup"] = _dump_markup(buttons)
     return data
 
 
@@ -103,27 +424,118 @@ def send_msg(text, chat_id=CHAT_ID, buttons=None):
     return tg_req("sendMessage", data).get("result", {}).get("message_id")
 
 
-def edit_msg(msg_id, text, chat_id=CHAT_ID, buttons=None):
+_edit_lock = threading.Lock()
+_edit_state = {}
+
+
+# Edits a message, skipping repeats of the text it already shows
+# With throttle, edits closer than EDIT_MIN_INTERVAL are deferred and only
+# the newest deferred edit is sent; unthrottled edits always go out at once
+def edit_msg(msg_id, text, chat_id=CHAT_ID, buttons=None, throttle=False):
     if not msg_id or not chat_id:
         return
     data = _get_tg_payload(chat_id, text, buttons, msg_id)
-    tg_req("editMessageText", data)
+    key = (chat_id, msg_id)
+
+    with _edit_lock:
+        state = _edit_state.setdefault(
+            key,
+            {
+                "seq": 0,
+                "time": 0,
+                "data": None,
+                "timer": None,
+                "send": threading.Lock(),
+            },
+        )
+        if state["timer"]:
+            state["timer"].cancel()
+            state["timer"] = None
+        state["seq"] += 1
+        seq = state["seq"]
+        wait = state["time"] + EDIT_MIN_INTERVAL - time.monotonic()
+        if throttle and wait > 0:
+            state["timer"] = threading.Timer(wait, _send_edit, (key, seq, data))
+            state["timer"].daemon = True
+            state["timer"].start()
+            return
+
+    _send_edit(key, seq, data)
+
+
+def _send_edit(key, seq, data):
+    state = _edit_state[key]
+    with state["send"]:
+        with _edit_lock:
+            # A newer edit superseded this one, or the text is already shown
+            if seq != state["seq"] or data == state["data"]:
+                return
+            state["time"] = time.monotonic()
+            state["data"] = data
+        tg_req("editMessageText", data)
 
 
 def send_doc(file_path, chat_id=CHAT_ID):
     if not chat_id:
         return
-    if os.path.exists(file_path):
-        with open(file_path, "rb") as f:
-            tg_req(
-                "sendDocument",
-                {"chat_id": chat_id, "parse_mode": "html"},
-                files={"document": f},
-            )
+    if not _stat(file_path):
+        return
+    with open(file_path, "rb") as f:
+        tg_req(
+            "sendDocument",
+            {"chat_id": chat_id, "parse_mode": "html"},
+            files={"document": f},
+        )
+
+
+# Sends progress edits from a background thread
+# Only the newest pending text is kept, older frames are dropped
+class ProgressUpdater:
+    def __init__(self, msg_id, chat_id=CHAT_ID):
+        self.msg_id = msg_id
+        self.chat_id = chat_id
+        self.pending = queue.Queue(maxsize=1)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            text = self.pending.get()
+            if text is None:
+                break
+            edit_msg(self.msg_id, text, self.chat_id, throttle=True)
+
+    def _replace(self, item):
+        try:
+            self.pending.put_nowait(item)
+        except queue.Full:
+            try:
+                self.pending.get_nowait()
+            except queue.Empty:
+                pass
+            self.pending.put_nowait(item)
+
+    def update(self, text):
+        self._replace(text)
 
+    # Drops any stale edit and waits for the one in flight to finish
+    def stop(self):
+        self._replace(None)
+        self.thread.join()
+
+
+# Upload responses that carry the created file, 204 would have no body to read
+_UPLOAD_OK = frozenset({200, 201})
 
 # Upload for PixelDrain
-def upload_pd(path):
+_PD_AUTH_HEADER = (
+    {"Authorization": "Basic " + base64.b64encode(f":{PD_API}".encode()).decode()}
+    if PD_API
+    else None
+)
+
+
+def upload_pd(path, hasher=None):
     print(f"Uploading to PixelDrain: {path}")
     if not PD_API:
         print("PixelDrain API key missing.")
@@ -132,17 +544,13 @@ def upload_pd(path):
     file_name = os.path.basename(path)
     url = f"https://pixeldrain.com/api/file/{file_name}"
 
-    auth_str = f":{PD_API}"
-    auth_bytes = auth_str.encode("ascii")
-    base64_auth = base64.b64encode(auth_bytes).decode("ascii")
-
-    headers = {"Authorization": f"Basic {base64_auth}"}
-
     try:
-        with open(path, "rb") as f:
-            r = requests.put(url, data=f, headers=headers, timeout=300)
+        with _pd_slots, open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            body = UploadReader(f, size, hasher)
+            r = _pd_session.put(url, data=body, headers=_PD_AUTH_HEADER, timeout=300)
 
-        if r.status_code in [200, 201]:
+        if r.status_code in _UPLOAD_OK:
             return f"https://pixeldrain.com/u/{r.json().get('id')}"
 
         print(f"[PixelDrain Error {r.status_code}] {r.text}")
@@ -152,44 +560,190 @@ def upload_pd(path):
         return None
 
 
+# Seconds a looked up GoFile upload server is reused for
+GOFILE_SERVER_TTL = 300
+
+_gofile_lock = threading.Lock()
+_gofile_server = {"name": None, "time": 0}
+
+
+# Looks up the GoFile upload server, cached for GOFILE_SERVER_TTL
+def _get_gofile_server(refresh=False):
+    with _gofile_lock:
+        cached = _gofile_server["name"]
+        if cached and not refresh:
+            if time.monotonic() - _gofile_server["time"] < GOFILE_SERVER_TTL:
+                return cached
+
+        server_req = _gofile_session.get("https://api.gofile.io/servers", timeout=10)
+        data = server_req.json()
+        if data["status"] != "ok":
+            _gofile_server["name"] = None
+            return None
+        _gofile_server["name"] = data["data"]["servers"][0]["name"]
+        _gofile_server["time"] = time.monotonic()
+        return _gofile_server["name"]
+
+
+def _post_gofile(server, path, hasher):
+    with open(path, "rb") as f:
+        body = UploadReader(f, os.fstat(f.fileno()).st_size, hasher)
+        # Stream the multipart body instead of building it in memory
+        encoder = MultipartEncoder(
+            fields={"file": (os.path.basename(path), body, "application/octet-stream")}
+        )
+        return _gofile_session.post(
+            f"https://{server}.gofile.io/uploadFile",
+            data=encoder,
+            headers={"Content-Type": encoder.content_type},
+            timeout=300,
+        )
+
+
 # Upload for GoFile
-def upload_gofile(path):
+def upload_gofile(path, hasher=None):
     print(f"Uploading to GoFile: {path}")
     try:
-        server_req = requests.get("https://api.gofile.io/servers")
-        data = server_req.json()
-        if data["status"] != "ok":
+        server = _get_gofile_server()
+        if not server:
             return None
 
-        server = data["data"]["servers"][0]["name"]
-        with open(path, "rb") as f:
-            r = requests.post(
-                f"https://{server}.gofile.io/uploadFile",
-                files={"file": f},
-                timeout=300,
-            )
-        if r.status_code == 200:
+        try:
+            r = _post_gofile(server, path, hasher)
+            failure = None if r.status_code in _UPLOAD_OK else r.status_code
+        except requests.RequestException as e:
+            failure = e
+        if failure is not None:
+            # The cached server may have gone away, retry once on a fresh one
+            print(f"[GoFile Error {failure}] retrying with a new server")
+            server = _get_gofile_server(refresh=True)
+            if not server:
+                return None
+            if hasher:
+                hasher.reset()
+            r = _post_gofile(server, path, hasher)
+
+        if r.status_code in _UPLOAD_OK:
             return r.json()["data"]["downloadPage"]
         return None
     except Exception as e:
         print(f"GoFile Upload Error: {e}")
         return None
 
-# Performs simultaneous uploads
-def upload_all(path, use_gofile=False):
-    results = {"pd": None, "gf": None}
 
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        future_pd = executor.submit(upload_pd, path)
-        future_gf = executor.submit(upload_gofile, path) if use_gofile else None
+UPLOAD_CACHE = ".upload_cache.json"
+_upload_cache_lock = threading.Lock()
 
-        results["pd"] = future_pd.result()
-        if future_gf:
-            results["gf"] = future_gf.result()
 
+# Links of earlier PixelDrain uploads keyed by MD5, kept next to the build
+# GoFile has no public lookup to confirm a file still exists, so it's not cached
+def _load_upload_cache():
+    try:
+        with open(UPLOAD_CACHE, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_upload_cache(results):
+    with _upload_cache_lock:
+        cache = _load_upload_cache()
+        for path, result in results.items():
+            if result["md5"] and result["pd"]:
+                cache[result["md5"]] = {
+                    "size": result["size"] or os.path.getsize(path),
+                    "pd": result["pd"],
+                }
+        try:
+            tmp = UPLOAD_CACHE + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump(cache, f)
+            os.replace(tmp, UPLOAD_CACHE)
+        except OSError as e:
+            print(f"Upload cache not saved: {e}")
+
+
+# Reuses a cached PixelDrain link if its file is still there, uploads otherwise
+def _upload_pd_or_reuse(entry, path, hasher):
+    url = entry.get("pd")
+    if url:
+        file_id = url.rsplit("/", 1)[-1]
+        try:
+            r = _pd_session.get(
+                f"https://pixeldrain.com/api/file/{file_id}/info", timeout=5
+            )
+            if r.status_code == 200 and r.json().get("size") == entry.get("size"):
+                print(f"Reusing earlier upload of {path}: {url}")
+                return url
+        except (requests.RequestException, ValueError):
+            pass
+    return upload_pd(path, hasher)
+
+
+# Uploads every file to every backend at once
+# Each file's MD5 and size are taken from the read pass of one of its uploads,
+# or computed next to them when no upload reads the file
+# Files matching an earlier upload by size and MD5 reuse its PixelDrain link
+def upload_many(paths, use_gofile=False):
+    results = {
+        path: {"pd": None, "gf": None, "md5": None, "size": None} for path in paths
+    }
+    hashers = {path: FileDigest() for path in paths}
+    hashed_by = "pd" if PD_API else ("gf" if use_gofile else None)
+
+    # Only files sized like a cached upload are hashed ahead of time
+    cache = _load_upload_cache()
+    cached_sizes = {entry.get("size") for entry in cache.values()}
+    entries = {}
+    for path in paths:
+        st = _stat(path)
+        if st and st.st_size in cached_sizes:
+            md5 = get_md5(path)
+            if md5 in cache:
+                results[path]["md5"] = md5
+                results[path]["size"] = st.st_size
+                entries[path] = cache[md5]
+
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=max(1, len(paths) * 2)
+    ) as executor:
+        futures = {}
+        for path in paths:
+            entry = entries.get(path, {})
+            pd_hasher = hashers[path] if hashed_by == "pd" else None
+            future = executor.submit(_upload_pd_or_reuse, entry, path, pd_hasher)
+            futures[future] = (path, "pd")
+            if use_gofile:
+                gf_hasher = hashers[path] if hashed_by == "gf" else None
+                future = executor.submit(upload_gofile, path, gf_hasher)
+                futures[future] = (path, "gf")
+            if not hashed_by and path not in entries:
+                futures[executor.submit(get_md5, path)] = (path, "md5")
+
+        for future, (path, backend) in futures.items():
+            results[path][backend] = future.result()
+
+    for path in paths:
+        if path in entries:
+            continue
+        if hashed_by and results[path][hashed_by]:
+            results[path]["md5"] = hashers[path].hexdigest()
+            results[path]["size"] = hashers[path].size
+        elif results[path]["md5"] == "N/A":
+            results[path]["md5"] = None
+
+    _save_upload_cache(results)
     return results
 
 
+# Builds run in their own session, so signal the whole process group
+def _kill_group(process, sig):
+    try:
+        os.killpg(os.getpgid(process.pid), sig)
+    except ProcessLookupError:
+        pass
+
+
 # Signal handler to kill build processes
 def register_signal_handler(process_getter):
 
@@ -199,10 +753,14 @@ def register_signal_handler(process_getter):
 
         if process and process.poll() is None:
             print("[BOT] Killing build process...")
-            process.terminate()
-            time.sleep(1)
-            if process.poll() is None:
-                process.kill()
+            _kill_group(process, signal.SIGTERM)
+            try:
+                process.wait(timeout=1)
+            except subprocess.TimeoutExpired:
+                _kill_group(process, signal.SIGKILL)
+                process.wait()
         sys.exit(0)
 
-    signal.signal(signal.SIGINT, handler)
+    # The build has its own session, so hangups and stops only reach the bot
+    for sig in (signal.SIGINT, signal.SIGTERM, signal.SIGHUP):
+        signal.signal(sig, handler)